@@ -1,8 +1,94 @@
+import logging
+import math
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.core.mail.backends.base import BaseEmailBackend
 
-from djcelery_email.tasks import send_emails
-from djcelery_email.utils import chunked, email_to_dict
+from djcelery_email.tasks import send_emails, send_emails_batched
+from djcelery_email.utils import BINARY_SERIALIZERS, chunked, email_to_dict
+
+logger = logging.getLogger(__name__)
+
+# seconds a measured queue depth is used before the broker is asked again
+QUEUE_DEPTH_TTL = 5
+
+_queue_depths = {}
+
+
+def _get_queue_depth(app, queue):
+    """
+    Returns the number of messages waiting in 'queue', or None if the broker
+    can't tell. Measurements are cached for QUEUE_DEPTH_TTL seconds.
+    """
+    now = time.monotonic()
+    measured_at, depth = _queue_depths.get(queue, (None, None))
+    if measured_at is not None and now - measured_at < QUEUE_DEPTH_TTL:
+        return depth
+
+    try:
+        with app.connection_for_read() as conn:
+            depth = conn.default_channel.queue_declare(queue, passive=True).message_count
+    except Exception:
+        logger.warning("Cannot determine the depth of queue %r", queue, exc_info=True)
+        depth = None
+    _queue_depths[queue] = (now, depth)
+    return depth
+
+
+def get_chunk_size():
+    """
+    Returns CELERY_EMAIL_CHUNK_SIZE, or the size from CELERY_EMAIL_CHUNK_SIZE_LADDER
+    matching the current depth of the email queue.
+    """
+    chunksize = settings.CELERY_EMAIL_CHUNK_SIZE
+    if not settings.CELERY_EMAIL_CHUNK_SIZE_LADDER:
+        return chunksize
+
+    # the queue the chunks are published to, honouring task_routes like apply_async does
+    options = {'queue': send_emails.queue} if getattr(send_emails, 'queue', None) else {}
+    queue = send_emails.app.amqp.router.route(options, send_emails.name)['queue'].name
+    depth = _get_queue_depth(send_emails.app, queue)
+    if depth is None:
+        return chunksize
+
+    for min_depth, size in sorted(settings.CELERY_EMAIL_CHUNK_SIZE_LADDER):
+        if depth >= min_depth:
+            chunksize = size
+    return chunksize
+
+
+def get_chunk_sizes():
+    """
+    Yields the size of each successive chunk of a mailing: the size from
+    get_chunk_size(), growing with the number of messages already queued
+    if CELERY_EMAIL_CHUNK_GROWTH is set.
+    """
+    growth = settings.CELERY_EMAIL_CHUNK_GROWTH
+    if not growth:
+        chunksize = get_chunk_size()
+        while True:
+            yield chunksize
+
+    try:
+        threshold, max_chunk_size = growth['threshold'], growth['max_chunk_size']
+    except (KeyError, TypeError):
+        raise ImproperlyConfigured("CELERY_EMAIL_CHUNK_GROWTH requires a 'threshold' and a 'max_chunk_size'.")
+    if threshold <= 0 or max_chunk_size < 1:
+        raise ImproperlyConfigured("CELERY_EMAIL_CHUNK_GROWTH 'threshold' and 'max_chunk_size' must be positive.")
+
+    # grows with the square root of the backlog, so the first chunks of a
+    # mailing stay small and reach the (idle) workers quickly
+    chunksize = get_chunk_size()
+    queued = 0
+    while True:
+        size = int(chunksize * (1 + math.sqrt(queued / threshold)))
+        size = min(size, max_chunk_size)
+        yield size
+        queued += size
 
 
 class CeleryEmailBackend(BaseEmailBackend):
@@ -11,8 +97,59 @@ class CeleryEmailBackend(BaseEmailBackend):
         self.init_kwargs = kwargs
 
     def send_messages(self, email_messages):
+        if settings.CELERY_EMAIL_USE_BATCHES:
+            return self._send_batched(email_messages)
+
+        if send_emails.app.conf.task_always_eager:
+            # the messages never leave this process, so there's no need to
+            # convert them to dicts and back, or to ask the broker for a chunk size
+            return [send_emails.apply((chunk, self.init_kwargs))
+                    for chunk in chunked(email_messages, settings.CELERY_EMAIL_CHUNK_SIZE)]
+
+        binary = send_emails.serializer in BINARY_SERIALIZERS
+        # convert lazily, so only the chunk being published is held as dicts
+        message_dicts = (email_to_dict(msg, binary=binary) for msg in email_messages)
+        chunks = chunked(message_dicts, get_chunk_sizes())
+
+        threads = settings.CELERY_EMAIL_PUBLISH_THREADS
+        if threads > 1:
+            return self._publish_threaded(chunks, threads)
+
+        result_tasks = []
+        # publish every chunk through a single producer (and broker connection)
+        # instead of acquiring one per task as 'delay' would
+        with send_emails.app.producer_pool.acquire(block=True) as producer:
+            for chunk_messages in chunks:
+                result_tasks.append(send_emails.apply_async((chunk_messages, self.init_kwargs),
+                                                            producer=producer))
+        return result_tasks
+
+    def _publish_threaded(self, chunks, threads):
+        # every thread publishes through a producer of its own; at most 'threads'
+        # chunks are in flight, so the mailing is still converted lazily
+        result_tasks = []
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for chunk_messages in chunks:
+                if len(pending) >= threads:
+                    result_tasks.append(pending.popleft().result())
+                pending.append(executor.submit(self._publish_chunk, chunk_messages))
+            result_tasks.extend(future.result() for future in pending)
+        return result_tasks
+
+    def _publish_chunk(self, chunk_messages):
+        with send_emails.app.producer_pool.acquire(block=True) as producer:
+            return send_emails.apply_async((chunk_messages, self.init_kwargs), producer=producer)
+
+    def _send_batched(self, email_messages):
+        # every message is its own request, celery-batches coalesces them on the worker
+        if send_emails_batched is None:
+            raise ImproperlyConfigured("CELERY_EMAIL_USE_BATCHES requires the celery-batches package.")
+
         result_tasks = []
-        for chunk in chunked(email_messages, settings.CELERY_EMAIL_CHUNK_SIZE):
-            chunk_messages = [email_to_dict(msg) for msg in chunk]
-            result_tasks.append(send_emails.delay(chunk_messages, self.init_kwargs))
+        binary = send_emails_batched.serializer in BINARY_SERIALIZERS
+        with send_emails_batched.app.producer_pool.acquire(block=True) as producer:
+            for msg in email_messages:
+                result_tasks.append(send_emails_batched.apply_async(
+                    (email_to_dict(msg, binary=binary), self.init_kwargs), producer=producer))
         return result_tasks
@@ -8,4 +8,10 @@ class DjangoCeleryEmailAppConf(AppConf):
     TASK_CONFIG = {}
     BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
     CHUNK_SIZE = 10
+    CHUNK_SIZE_LADDER = None
+    CHUNK_GROWTH = None
+    PUBLISH_THREADS = 1
     MESSAGE_EXTRA_ATTRIBUTES = None
+    REUSE_CONNECTION = False
+    USE_BATCHES = False
+    BATCH_TASK_CONFIG = {}
@@ -1,62 +1,211 @@
+import threading
+from functools import lru_cache
+
 from django.conf import settings
-from django.core.mail import EmailMessage, get_connection
+from django.core.mail import EmailMessage
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
 
 from celery import shared_task
+from celery.signals import worker_process_shutdown, worker_shutdown
+from kombu.serialization import register
+
+try:
+    from celery_batches import Batches
+except ImportError:
+    Batches = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Make sure our AppConf is loaded properly.
 import djcelery_email.conf  # noqa
-from djcelery_email.utils import dict_to_email, email_to_dict
+from djcelery_email.utils import BINARY_SERIALIZERS, dict_to_email, email_to_dict
+
+# Messages sent through the broker *must* be dicts, not instances of the
+# EmailMessage class. This is because we expect Celery to use JSON encoding, and
+# we want to prevent code assuming otherwise. Only callers running the task in
+# the same process (e.g. the backend in eager mode) may pass EmailMessage objects.
 
-# Messages *must* be dicts, not instances of the EmailMessage class
-# This is because we expect Celery to use JSON encoding, and we want to prevent
-# code assuming otherwise.
+# make the faster orjson available as the 'orjson' serializer, e.g. for
+# CELERY_EMAIL_TASK_CONFIG = {'serializer': 'orjson'}
+if orjson is not None:
+    register('orjson', lambda obj: orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS), orjson.loads,
+             content_type='application/x-orjson', content_encoding='utf-8')
 
-TASK_CONFIG = {'name': 'djcelery_email_send_multiple', 'ignore_result': True}
+TASK_CONFIG = {'name': 'djcelery_email_send_multiple', 'ignore_result': True, 'acks_late': True}
 TASK_CONFIG.update(settings.CELERY_EMAIL_TASK_CONFIG)
 
 # import base if string to allow a base celery task
 if 'base' in TASK_CONFIG and isinstance(TASK_CONFIG['base'], str):
-    from django.utils.module_loading import import_string
     TASK_CONFIG['base'] = import_string(TASK_CONFIG['base'])
 
+# the batched task gets a queue of its own: its workers have to prefetch whole batches,
+# while the regular email queue is best consumed with a prefetch multiplier of 1
+BATCH_TASK_CONFIG = {'name': 'djcelery_email_send_batched', 'ignore_result': True,
+                     'queue': 'djcelery_email_batched', 'flush_every': 100, 'flush_interval': 1}
+BATCH_TASK_CONFIG.update(settings.CELERY_EMAIL_BATCH_TASK_CONFIG)
 
-@shared_task(**TASK_CONFIG)
-def send_emails(messages, backend_kwargs=None, **kwargs):
-    # backward compat: handle **kwargs and missing backend_kwargs
-    combined_kwargs = {}
-    if backend_kwargs is not None:
-        combined_kwargs.update(backend_kwargs)
-    combined_kwargs.update(kwargs)
 
-    # backward compat: catch single object or dict
-    if isinstance(messages, (EmailMessage, dict)):
-        messages = [messages]
+@lru_cache(maxsize=8)
+def _resolve_backend(path):
+    return import_string(path)
+
+
+@receiver(setting_changed)
+def _clear_backend_cache(setting, **kwargs):
+    if setting == 'CELERY_EMAIL_BACKEND':
+        _resolve_backend.cache_clear()
+
+
+def _get_connection(backend_kwargs):
+    """
+    Like django.core.mail.get_connection(), for CELERY_EMAIL_BACKEND, but
+    without importing the backend class again for every task.
+    """
+    return _resolve_backend(settings.CELERY_EMAIL_BACKEND)(**backend_kwargs)
+
+
+# Idle backend connections kept open between tasks (CELERY_EMAIL_REUSE_CONNECTION),
+# per process and keyed by backend kwargs. A task checks a connection out for as
+# long as it sends, so connections are never shared between concurrent tasks,
+# whether the pool runs them in processes, threads or greenlets.
+MAX_IDLE_CONNECTIONS = 8
+
+_lock = threading.Lock()
+_idle_connections = {}
+
+
+def _connection_key(backend_kwargs):
+    return settings.CELERY_EMAIL_BACKEND, repr(sorted(backend_kwargs.items()))
+
+
+def _checkout_connection(backend_kwargs):
+    """
+    Returns a connection to CELERY_EMAIL_BACKEND for 'backend_kwargs', reusing
+    an idle one if there is one that's still alive.
+    """
+    with _lock:
+        idle = _idle_connections.get(_connection_key(backend_kwargs))
+        conn = idle.pop() if idle else None
+
+    if conn is None:
+        return _get_connection(backend_kwargs)
+
+    if getattr(conn, 'connection', None) is not None and hasattr(conn.connection, 'noop'):
+        # SMTP servers drop idle clients, check the connection is still usable
+        try:
+            alive = conn.connection.noop()[0] == 250
+        except Exception:
+            alive = False
+        if not alive:
+            _close_connection(conn)
+            conn = _get_connection(backend_kwargs)
+    return conn
 
-    # make sure they're all dicts
-    messages = [email_to_dict(m) for m in messages]
 
-    conn = get_connection(backend=settings.CELERY_EMAIL_BACKEND, **combined_kwargs)
+def _checkin_connection(conn, backend_kwargs):
+    """
+    Keeps 'conn' open for the next task, unless MAX_IDLE_CONNECTIONS are
+    idle already.
+    """
+    with _lock:
+        if sum(len(idle) for idle in _idle_connections.values()) < MAX_IDLE_CONNECTIONS:
+            _idle_connections.setdefault(_connection_key(backend_kwargs), []).append(conn)
+            return
+    _close_connection(conn)
+
+
+def _close_connection(conn):
+    # closing a connection the server has dropped may raise (e.g. SMTPException
+    # without fail_silently), which mustn't fail the task sending the messages
+    try:
+        conn.close()
+    except Exception:
+        logger.exception("Cannot close connection to CELERY_EMAIL_BACKEND")
+
+
+def _close_cached_connections(**kwargs):
+    with _lock:
+        connections = [conn for idle in _idle_connections.values() for conn in idle]
+        _idle_connections.clear()
+    for conn in connections:
+        _close_connection(conn)
+
+
+worker_process_shutdown.connect(_close_cached_connections)
+worker_shutdown.connect(_close_cached_connections)
+
+
+def _send_messages(messages, backend_kwargs):
+    """
+    Sends the message dicts (or EmailMessage objects) in 'messages' over a
+    single connection.
+
+    Returns the number of messages sent and a list of (message, exception)
+    tuples for the messages that could not be sent.
+    """
+    reuse_connection = settings.CELERY_EMAIL_REUSE_CONNECTION
+    if reuse_connection:
+        conn = _checkout_connection(backend_kwargs)
+    else:
+        conn = _get_connection(backend_kwargs)
     try:
         conn.open()
     except Exception:
         logger.exception("Cannot reach CELERY_EMAIL_BACKEND %s", settings.CELERY_EMAIL_BACKEND)
 
     messages_sent = 0
+    failed = []
 
     for message in messages:
+        to = message.to if isinstance(message, EmailMessage) else message['to']
         try:
-            sent = conn.send_messages([dict_to_email(message)])
+            email = message if isinstance(message, EmailMessage) else dict_to_email(message)
+            sent = conn.send_messages([email])
             if sent is not None:
                 messages_sent += sent
-            logger.debug("Successfully sent email message to %r.", message['to'])
+            logger.debug("Successfully sent email message to %r.", to)
         except Exception as e:
             # Not expecting any specific kind of exception here because it
             # could be any number of things, depending on the backend
             logger.warning("Failed to send email message to %r, retrying. (%r)",
-                           message['to'], e)
-            send_emails.retry([[message], combined_kwargs], exc=e, throw=False)
+                           to, e)
+            failed.append((message, e))
+
+    if reuse_connection:
+        _checkin_connection(conn, backend_kwargs)
+    else:
+        conn.close()
+    return messages_sent, failed
+
+
+@shared_task(**TASK_CONFIG)
+def send_emails(messages, backend_kwargs=None, **kwargs):
+    # backward compat: handle **kwargs and missing backend_kwargs
+    combined_kwargs = {}
+    if backend_kwargs is not None:
+        combined_kwargs.update(backend_kwargs)
+    combined_kwargs.update(kwargs)
+
+    # backward compat: catch single object or dict
+    if isinstance(messages, (EmailMessage, dict)):
+        messages = [messages]
+
+    # don't open a connection to the backend just to send nothing
+    if not messages:
+        return 0
+
+    messages_sent, failed = _send_messages(messages, combined_kwargs)
+    if failed:
+        # requeue all failed messages as a single retry task, as dicts since
+        # the retry goes through the broker
+        failed_messages = [email_to_dict(message) for message, e in failed]
+        send_emails.retry([failed_messages, combined_kwargs], exc=failed[-1][1], throw=False)
 
-    conn.close()
     return messages_sent
 
 
@@ -64,6 +213,48 @@ def send_emails(messages, backend_kwargs=None, **kwargs):
 SendEmailTask = send_email = send_emails
 
 
+if Batches is not None:
+    @shared_task(base=Batches, **BATCH_TASK_CONFIG)
+    def send_emails_batched(requests):
+        """
+        Sends the single messages buffered by celery-batches, using one
+        connection per distinct set of backend kwargs.
+        """
+        batches = []
+        for request in requests:
+            message, backend_kwargs = request.args
+            for kwargs, messages in batches:
+                if kwargs == backend_kwargs:
+                    messages.append(message)
+                    break
+            else:
+                batches.append((backend_kwargs, [message]))
+
+        messages_sent = 0
+        retries = []
+        for backend_kwargs, messages in batches:
+            sent, failed = _send_messages(messages, backend_kwargs)
+            messages_sent += sent
+            if failed:
+                retries.append((backend_kwargs, [message for message, e in failed]))
+
+        # individual requests can't be retried, hand failures to the regular task,
+        # encoded for its serializer rather than ours
+        binary = send_emails.serializer in BINARY_SERIALIZERS
+        for backend_kwargs, failed_messages in retries:
+            failed_messages = [email_to_dict(dict_to_email(message), binary=binary)
+                               for message in failed_messages]
+            try:
+                send_emails.apply_async((failed_messages, backend_kwargs),
+                                        countdown=send_emails.default_retry_delay)
+            except Exception:
+                logger.exception("Cannot requeue %d failed email messages", len(failed_messages))
+
+        return messages_sent
+else:
+    send_emails_batched = None
+
+
 try:
     from celery.utils.log import get_task_logger
     logger = get_task_logger(__name__)
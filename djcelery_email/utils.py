@@ -1,32 +1,61 @@
 import copy
 import base64
+from itertools import islice, repeat
 from email.mime.base import MIMEBase
+from typing import Any, Dict, Iterable, Iterator, List, TypeVar, Union, cast
 
 from django.conf import settings
 from django.core.mail import EmailMultiAlternatives, EmailMessage
 
+# Celery serializers that can carry raw bytes, so attachments don't need to be
+# base64 encoded to survive the trip through the broker.
+BINARY_SERIALIZERS = ('msgpack', 'pickle')
 
-def chunked(iterator, chunksize):
+T = TypeVar('T')
+
+
+def chunked(iterator: Iterable[T], chunksize: Union[int, Iterable[int]]) -> Iterator[List[T]]:
     """
-    Yields items from 'iterator' in chunks of size 'chunksize'.
+    Yields items from 'iterator' in chunks of size 'chunksize', which may also
+    be an iterable giving the size of each successive chunk.
+
+    Only one chunk is consumed from 'iterator' at a time, so it may be a
+    generator producing the items lazily.
+
+    Raises ValueError for a chunk size below 1.
 
     >>> list(chunked([1, 2, 3, 4, 5], chunksize=2))
-    [(1, 2), (3, 4), (5,)]
+    [[1, 2], [3, 4], [5]]
+    >>> list(chunked([1, 2, 3, 4, 5], chunksize=[1, 2, 3]))
+    [[1], [2, 3], [4, 5]]
     """
-    chunk = []
-    for idx, item in enumerate(iterator, 1):
-        chunk.append(item)
-        if idx % chunksize == 0:
-            yield chunk
-            chunk = []
+    items = iter(iterator)
+    sizes = repeat(chunksize) if isinstance(chunksize, int) else iter(chunksize)
+    for size in sizes:
+        if size < 1:
+            raise ValueError("Chunk size must be at least 1, not %r" % size)
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+    # out of sizes, put the remaining items in a last chunk
+    chunk = list(items)
     if chunk:
         yield chunk
 
 
-def email_to_dict(message):
+def email_to_dict(message: Union[EmailMessage, Dict[str, Any]], binary: bool = False) -> Dict[str, Any]:
+    """
+    Converts 'message' to a dict that can be serialized by Celery.
+
+    Attachment contents are base64 encoded unless 'binary' is set, in which
+    case they are kept as bytes (for use with one of BINARY_SERIALIZERS).
+    """
     if isinstance(message, dict):
         return message
 
+    # a dict display with constant keys is built in one step (BUILD_CONST_KEY_MAP),
+    # which is faster than zipping keys with an attrgetter() or a namedtuple's _asdict()
     message_dict = {'subject': message.subject,
                     'body': message.body,
                     'from_email': message.from_email,
@@ -36,7 +65,7 @@ def email_to_dict(message):
                     'attachments': [],
                     'headers': message.extra_headers,
                     'cc': message.cc,
-                    'reply_to': message.reply_to}
+                    'reply_to': message.reply_to}  # type: Dict[str, Any]
 
     if hasattr(message, 'alternatives'):
         message_dict['alternatives'] = message.alternatives
@@ -47,16 +76,25 @@ def email_to_dict(message):
 
     attachments = message.attachments
     for attachment in attachments:
+        binary_contents = None  # type: Any
         if isinstance(attachment, MIMEBase):
             filename = attachment.get_filename('')
-            binary_contents = attachment.get_payload(decode=True)
             mimetype = attachment.get_content_type()
+            if not binary and attachment.get('Content-Transfer-Encoding') == 'base64':
+                # the payload is base64 encoded already, no need to decode and re-encode it
+                payload = cast(str, attachment.get_payload())
+                message_dict['attachments'].append((filename, ''.join(payload.split()), mimetype))
+                continue
+            binary_contents = attachment.get_payload(decode=True)
         else:
             filename, binary_contents, mimetype = attachment
             # For a mimetype starting with text/, content is expected to be a string.
             if isinstance(binary_contents, str):
                 binary_contents = binary_contents.encode()
-        contents = base64.b64encode(binary_contents).decode('ascii')
+        if binary:
+            contents = binary_contents
+        else:
+            contents = base64.b64encode(binary_contents).decode('ascii')
         message_dict['attachments'].append((filename, contents, mimetype))
 
     if settings.CELERY_EMAIL_MESSAGE_EXTRA_ATTRIBUTES:
@@ -67,7 +105,7 @@ def email_to_dict(message):
     return message_dict
 
 
-def dict_to_email(messagedict):
+def dict_to_email(messagedict: Dict[str, Any]) -> EmailMessage:
     message_kwargs = copy.deepcopy(messagedict)  # prevents missing items on retry
 
     # remove items from message_kwargs until only valid EmailMessage/EmailMultiAlternatives kwargs are left
@@ -75,17 +113,19 @@ def dict_to_email(messagedict):
     message_attributes = ['content_subtype', 'mixed_subtype']
     if settings.CELERY_EMAIL_MESSAGE_EXTRA_ATTRIBUTES:
         message_attributes.extend(settings.CELERY_EMAIL_MESSAGE_EXTRA_ATTRIBUTES)
-    attributes_to_copy = {}
+    attributes_to_copy = {}  # type: Dict[str, Any]
     for attr in message_attributes:
         if attr in message_kwargs:
             attributes_to_copy[attr] = message_kwargs.pop(attr)
 
     # remove attachments from message_kwargs then reinsert after base64 decoding
+    # (contents are already bytes if they were sent with a binary serializer)
     attachments = message_kwargs.pop('attachments')
     message_kwargs['attachments'] = []
     for attachment in attachments:
         filename, contents, mimetype = attachment
-        contents = base64.b64decode(contents.encode('ascii'))
+        if not isinstance(contents, bytes):
+            contents = base64.b64decode(contents)
 
         # For a mimetype starting with text/, content is expected to be a string.
         if mimetype and mimetype.startswith('text/'):
@@ -14,6 +14,13 @@ about = {}
 with open(os.path.join(base_dir, 'djcelery_email', '__about__.py')) as f:
     exec(f.read(), about)
 
+# Optionally compile the message (de)serialization helpers with mypyc,
+# e.g. DJCELERY_EMAIL_MYPYC=1 pip install django-celery-email --no-binary :all:
+ext_modules = []
+if os.environ.get('DJCELERY_EMAIL_MYPYC'):
+    from mypyc.build import mypycify
+    ext_modules = mypycify(['--ignore-missing-imports', 'djcelery_email/utils.py'])
+
 
 setup(
     name=about['__title__'],
@@ -28,11 +35,17 @@ setup(
     packages=find_packages(exclude=['ez_setup', 'tests']),
     scripts=[],
     zip_safe=False,
+    ext_modules=ext_modules,
     install_requires=[
         'django>=2.2',
         'celery>=4.0',
         'django-appconf',
     ],
+    extras_require={
+        'batches': ['celery-batches'],
+        'msgpack': ['msgpack'],
+        'orjson': ['orjson'],
+    },
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Framework :: Django',
@@ -1,8 +1,14 @@
+import hashlib
 import json
 import os.path
+import smtplib
+from collections import namedtuple
+from contextlib import contextmanager
+from unittest import mock, skipIf
 from email.mime.image import MIMEImage
 
 from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
 from django.core.mail.backends.base import BaseEmailBackend
 from django.core.mail.backends import locmem
 from django.core.mail import EmailMultiAlternatives
@@ -10,19 +16,39 @@ from django.test import TestCase
 from django.test.utils import override_settings
 
 import celery
-from djcelery_email import tasks
-from djcelery_email.utils import email_to_dict, dict_to_email
+from celery.app.amqp import Queues
+from celery.app.routes import Router, prepare as prepare_routes
+from kombu.exceptions import EncodeError
+from kombu.serialization import dumps, loads
+from djcelery_email import backends, tasks
+from djcelery_email.utils import chunked, email_to_dict, dict_to_email
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 def even(n):
     return n % 2 == 0
 
 
+def fingerprint(msg):
+    """ Returns a digest of the dict representation of 'msg'. """
+    serialized = json.dumps(email_to_dict(msg), sort_keys=True, default=str)
+    if hasattr(hashlib, 'blake2b'):
+        return hashlib.blake2b(serialized.encode(), digest_size=16).digest()
+    # Python 3.5 has no blake2b
+    return hashlib.sha256(serialized.encode()).digest()
+
+
 def celery_queue_pop():
     """ Pops a single task from Celery's 'memory://' queue. """
     with celery.current_app.connection() as conn:
-        queue = conn.SimpleQueue('django_email', no_ack=True)
-        return queue.get().payload
+        # fetch straight from the channel, a SimpleQueue would declare the
+        # exchange, queue and binding first
+        message = conn.default_channel.basic_get('django_email', no_ack=True)
+        return json.loads(message.body) if message else None
 
 
 class TracingBackend(BaseEmailBackend):
@@ -33,6 +59,37 @@ class TracingBackend(BaseEmailBackend):
         self.__class__.called = True
 
 
+class CountingBackend(locmem.EmailBackend):
+    """ Counts how many connections have been created. """
+    instances = 0
+
+    def __init__(self, *args, **kwargs):
+        super(CountingBackend, self).__init__(*args, **kwargs)
+        self.__class__.instances += 1
+
+
+class FakeBrokerApp(object):
+    """ Just enough of a Celery app to report the depth of a queue. """
+    def __init__(self, depth):
+        self.depth = depth
+        self.declared = []
+
+    @contextmanager
+    def connection_for_read(self):
+        app = self
+
+        class Channel(object):
+            def queue_declare(self, queue, passive=False):
+                app.declared.append((queue, passive))
+                return mock.Mock(message_count=app.depth)
+
+        yield mock.Mock(default_channel=Channel())
+
+
+# stands in for the requests celery-batches hands to a batch task
+BatchRequest = namedtuple('BatchRequest', ['args', 'kwargs'])
+
+
 class UtilTests(TestCase):
     @override_settings(CELERY_EMAIL_MESSAGE_EXTRA_ATTRIBUTES=['extra_attribute'])
     def test_email_to_dict_extra_attrs(self):
@@ -54,6 +111,38 @@ class UtilTests(TestCase):
             email_to_dict(dict_to_email(json.loads(serialized))),
             email_to_dict(msg))
 
+    def check_msgpack_of_msg(self, msg):
+        if msgpack is None:
+            self.skipTest('msgpack is not installed')
+        content_type, content_encoding, data = dumps(email_to_dict(msg, binary=True), serializer='msgpack')
+        self.assertEqual(
+            email_to_dict(dict_to_email(loads(data, content_type, content_encoding, accept=[content_type]))),
+            email_to_dict(msg))
+
+    def test_chunked_invalid_size(self):
+        with self.assertRaises(ValueError):
+            list(chunked([1, 2, 3], 0))
+        with self.assertRaises(ValueError):
+            list(chunked([1, 2, 3], [2, 0]))
+
+    @skipIf(tasks.orjson is None, 'orjson is not installed')
+    def test_orjson_serializer(self):
+        msg = mail.EmailMessage(
+            'test', 'Testing with Celery! w00t!!', 'from@example.com',
+            ['to@example.com'], headers={'X-Test': 'value'})
+        msg.attach('data.csv', 'csv content', 'text/csv')
+        message_dict = email_to_dict(msg)
+        content_type, content_encoding, data = dumps(message_dict, serializer='orjson')
+        self.assertEqual(content_type, 'application/x-orjson')
+        self.assertEqual(loads(data, content_type, content_encoding, accept=[content_type]),
+                         json.loads(json.dumps(message_dict)))
+
+    def test_email_to_dict_binary(self):
+        msg = mail.EmailMessage()
+        msg.attach('data.bin', b'\x00\x01\x02', 'application/octet-stream')
+        self.assertEqual(email_to_dict(msg, binary=True)['attachments'],
+                         [('data.bin', b'\x00\x01\x02', 'application/octet-stream')])
+
     def test_email_with_attachment(self):
         file_path = os.path.join(os.path.dirname(__file__), 'image.png')
         with open(file_path, 'rb') as file:
@@ -63,6 +152,7 @@ class UtilTests(TestCase):
             ['to@example.com'])
         msg.attach('image.png', file_contents)
         self.check_json_of_msg(msg)
+        self.check_msgpack_of_msg(msg)
 
     def test_email_with_mime_attachment(self):
         file_path = os.path.join(os.path.dirname(__file__), 'image.png')
@@ -74,6 +164,7 @@ class UtilTests(TestCase):
             ['to@example.com'])
         msg.attach(mimg)
         self.check_json_of_msg(msg)
+        self.check_msgpack_of_msg(msg)
 
     def test_email_with_attachment_from_file(self):
         file_path = os.path.join(os.path.dirname(__file__), 'image.png')
@@ -82,6 +173,7 @@ class UtilTests(TestCase):
             ['to@example.com'])
         msg.attach_file(file_path)
         self.check_json_of_msg(msg)
+        self.check_msgpack_of_msg(msg)
 
 
 class TaskTests(TestCase):
@@ -93,6 +185,12 @@ class TaskTests(TestCase):
         - should pass the given kwargs to that backend
         - should retry sending failed messages (see TaskErrorTests)
     """
+    def assertEmailsEqual(self, msgs, other_msgs):
+        # compare digests first, only compare the dicts to show what differs
+        if [fingerprint(m) for m in msgs] != [fingerprint(m) for m in other_msgs]:
+            self.assertEqual([email_to_dict(m) for m in msgs],
+                             [email_to_dict(m) for m in other_msgs])
+
     def test_send_single_email_object(self):
         """ It should accept and send a single EmailMessage object. """
         msg = mail.EmailMessage()
@@ -135,8 +233,7 @@ class TaskTests(TestCase):
                           backend_kwargs={})
 
         self.assertEqual(len(mail.outbox), N)
-        for i in range(N):
-            self.assertEqual(email_to_dict(msgs[i]), email_to_dict(mail.outbox[i]))
+        self.assertEmailsEqual(msgs, mail.outbox)
 
     def test_send_multiple_email_dicts(self):
         """ It should accept and send a list of EmailMessage dicts. """
@@ -145,8 +242,7 @@ class TaskTests(TestCase):
         tasks.send_emails(msgs, backend_kwargs={})
 
         self.assertEqual(len(mail.outbox), N)
-        for i in range(N):
-            self.assertEqual(email_to_dict(msgs[i]), email_to_dict(mail.outbox[i]))
+        self.assertEmailsEqual(msgs, mail.outbox)
 
     def test_send_multiple_email_dicts_response(self):
         """ It should return the number of messages sent. """
@@ -180,6 +276,119 @@ class TaskTests(TestCase):
         tasks.send_email(email_to_dict(msg), foo='bar')
         self.assertEqual(TracingBackend.kwargs.get('foo'), 'bar')
 
+    @override_settings(CELERY_EMAIL_BACKEND='tests.tests.TracingBackend')
+    def test_send_empty_list(self):
+        """ It should not connect to the backend if there's nothing to send. """
+        TracingBackend.kwargs = None
+        messages_sent = tasks.send_emails([], backend_kwargs={})
+        self.assertEqual(messages_sent, 0)
+        self.assertIsNone(TracingBackend.kwargs)
+
+    @override_settings(CELERY_EMAIL_BACKEND='tests.tests.TracingBackend')
+    def test_backend_class_cached(self):
+        """ It should import the backend class only once. """
+        tasks.send_email(email_to_dict(mail.EmailMessage()), backend_kwargs={})
+        misses = tasks._resolve_backend.cache_info().misses
+        tasks.send_email(email_to_dict(mail.EmailMessage()), backend_kwargs={})
+        self.assertEqual(tasks._resolve_backend.cache_info().misses, misses)
+
+    @override_settings(CELERY_EMAIL_BACKEND='tests.tests.CountingBackend',
+                       CELERY_EMAIL_REUSE_CONNECTION=True)
+    def test_reuse_connection(self):
+        """ It should keep using the same connection for the same backend kwargs. """
+        self.addCleanup(tasks._close_cached_connections)
+        CountingBackend.instances = 0
+        tasks.send_email(mail.EmailMessage(), backend_kwargs={})
+        tasks.send_email(mail.EmailMessage(), backend_kwargs={})
+        self.assertEqual(CountingBackend.instances, 1)
+
+        tasks.send_email(mail.EmailMessage(), backend_kwargs={'foo': 'bar'})
+        self.assertEqual(CountingBackend.instances, 2)
+        self.assertEqual(len(mail.outbox), 3)
+
+    @override_settings(CELERY_EMAIL_BACKEND='tests.tests.CountingBackend',
+                       CELERY_EMAIL_REUSE_CONNECTION=True)
+    def test_reuse_connection_concurrently(self):
+        """ Connections in use should not be handed to other tasks, idle ones are bounded. """
+        self.addCleanup(tasks._close_cached_connections)
+        CountingBackend.instances = 0
+        conn1 = tasks._checkout_connection({})
+        conn2 = tasks._checkout_connection({})
+        self.assertIsNot(conn1, conn2)
+
+        with mock.patch.object(tasks, 'MAX_IDLE_CONNECTIONS', 1):
+            with mock.patch.object(conn2, 'close') as mock_close:
+                tasks._checkin_connection(conn1, {})
+                tasks._checkin_connection(conn2, {})
+                self.assertTrue(mock_close.called)
+
+        self.assertIs(tasks._checkout_connection({}), conn1)
+        self.assertEqual(CountingBackend.instances, 2)
+
+    @override_settings(CELERY_EMAIL_BACKEND='tests.tests.CountingBackend',
+                       CELERY_EMAIL_REUSE_CONNECTION=True)
+    def test_reuse_dropped_connection(self):
+        """ A connection the server dropped should be replaced, even if closing it fails. """
+        self.addCleanup(tasks._close_cached_connections)
+        CountingBackend.instances = 0
+        conn = tasks._checkout_connection({})
+        conn.connection = mock.Mock(**{'noop.side_effect': smtplib.SMTPServerDisconnected()})
+        tasks._checkin_connection(conn, {})
+
+        with mock.patch.object(conn, 'close', side_effect=smtplib.SMTPException()) as mock_close:
+            new_conn = tasks._checkout_connection({})
+        self.assertTrue(mock_close.called)
+        self.assertIsNot(new_conn, conn)
+        self.assertEqual(CountingBackend.instances, 2)
+
+
+@skipIf(tasks.send_emails_batched is None, 'celery-batches is not installed')
+class BatchedTaskTests(TestCase):
+    """
+    Tests that the 'tasks.send_emails_batched' task sends all buffered messages,
+    using one connection per set of backend kwargs.
+    """
+    @override_settings(CELERY_EMAIL_BACKEND='tests.tests.CountingBackend')
+    def test_send_batched_emails(self):
+        CountingBackend.instances = 0
+        msgs = [mail.EmailMessage(subject="msg %d" % i) for i in range(3)]
+        requests = [
+            BatchRequest((email_to_dict(msgs[0]), {}), {}),
+            BatchRequest((email_to_dict(msgs[1]), {'foo': 'bar'}), {}),
+            BatchRequest((email_to_dict(msgs[2]), {}), {}),
+        ]
+        messages_sent = tasks.send_emails_batched(requests)
+
+        self.assertEqual(messages_sent, 3)
+        self.assertEqual(CountingBackend.instances, 2)
+        self.assertEqual(
+            [msg.subject for msg in mail.outbox],
+            ["msg 0", "msg 2", "msg 1"]
+        )
+
+    @override_settings(CELERY_EMAIL_BACKEND='tests.tests.EvenErrorBackend')
+    def test_requeue_failed_emails(self):
+        """ Failures should be requeued for the regular task's serializer, group by group. """
+        msg = mail.EmailMessage(subject="msg")
+        msg.attach('data.bin', b'\x00\x01\x02', 'application/octet-stream')
+        # queued with a binary serializer, while the regular task uses JSON
+        requests = [
+            BatchRequest((email_to_dict(msg, binary=True), {}), {}),
+            BatchRequest((email_to_dict(msg, binary=True), {'foo': 'bar'}), {}),
+        ]
+        with mock.patch.object(tasks.send_emails, 'apply_async',
+                               side_effect=[EncodeError(), None]) as mock_apply_async:
+            messages_sent = tasks.send_emails_batched(requests)
+
+        self.assertEqual(messages_sent, 0)
+        # the failing publish of the first group doesn't stop the second one
+        self.assertEqual(mock_apply_async.call_count, 2)
+        (args,), options = mock_apply_async.call_args
+        messages, backend_kwargs = args
+        self.assertEqual(backend_kwargs, {'foo': 'bar'})
+        self.assertEqual(messages[0]['attachments'][0][1], 'AAEC')
+        self.assertEqual(options['countdown'], tasks.send_emails.default_retry_delay)
+
 
 class EvenErrorBackend(locmem.EmailBackend):
     """ Fails to deliver every 2nd message. """
@@ -200,21 +409,12 @@ class TaskErrorTests(TestCase):
     Tests that the 'tasks.send_emails' task does not crash if a single message
     could not be sent and that it requeues that message.
     """
-    # TODO: replace setUp/tearDown with 'unittest.mock' at some point
     def setUp(self):
         super(TaskErrorTests, self).setUp()
 
-        self._retry_calls = []
-
-        def mock_retry(*args, **kwargs):
-            self._retry_calls.append((args, kwargs))
-
-        self._old_retry = tasks.send_emails.retry
-        tasks.send_emails.retry = mock_retry
-
-    def tearDown(self):
-        super(TaskErrorTests, self).tearDown()
-        tasks.send_emails.retry = self._old_retry
+        retry_patch = mock.patch.object(tasks.send_emails, 'retry')
+        self.mock_retry = retry_patch.start()
+        self.addCleanup(retry_patch.stop)
 
     @override_settings(CELERY_EMAIL_BACKEND='tests.tests.EvenErrorBackend')
     def test_send_multiple_emails(self):
@@ -231,14 +431,23 @@ class TaskErrorTests(TestCase):
         )
 
         # Assert that "even"/bad messages have been requeued,
-        # one retry task per bad message.
-        self.assertEqual(len(self._retry_calls), 5)
-        odd_msgs = [msg for idx, msg in enumerate(msgs) if even(idx)]
-        for msg, (args, kwargs) in zip(odd_msgs, self._retry_calls):
-            retry_args = args[0]
-            self.assertEqual(retry_args, [[email_to_dict(msg)], {'foo': 'bar'}])
-            self.assertTrue(isinstance(kwargs.get('exc'), RuntimeError))
-            self.assertFalse(kwargs.get('throw', True))
+        # all in a single retry task.
+        self.assertEqual(len(self.mock_retry.call_args_list), 1)
+        even_msgs = [msg for idx, msg in enumerate(msgs) if even(idx)]
+        (retry_args,), kwargs = self.mock_retry.call_args_list[0]
+        self.assertEqual(retry_args, [[email_to_dict(msg) for msg in even_msgs], {'foo': 'bar'}])
+        self.assertTrue(isinstance(kwargs.get('exc'), RuntimeError))
+        self.assertFalse(kwargs.get('throw', True))
+
+    @override_settings(CELERY_EMAIL_BACKEND='tests.tests.EvenErrorBackend')
+    def test_send_multiple_email_objects(self):
+        """ Failed EmailMessage objects should be requeued as dicts. """
+        msgs = [mail.EmailMessage(subject="msg %d" % i) for i in range(4)]
+        tasks.send_emails(msgs, backend_kwargs={})
+
+        self.assertEqual(len(self.mock_retry.call_args_list), 1)
+        (retry_args,), kwargs = self.mock_retry.call_args_list[0]
+        self.assertEqual(retry_args, [[email_to_dict(msgs[0]), email_to_dict(msgs[2])], {}])
 
 
 class BackendTests(TestCase):
@@ -247,21 +456,12 @@ class BackendTests(TestCase):
     i.e. it submits the correct number of jobs (according to the chunk size)
     and passes backend parameters to the task.
     """
-    # TODO: replace setUp/tearDown with 'unittest.mock' at some point
     def setUp(self):
         super(BackendTests, self).setUp()
 
-        self._delay_calls = []
-
-        def mock_delay(*args, **kwargs):
-            self._delay_calls.append((args, kwargs))
-
-        self._old_delay = tasks.send_emails.delay
-        tasks.send_emails.delay = mock_delay
-
-    def tearDown(self):
-        super(BackendTests, self).tearDown()
-        tasks.send_emails.delay = self._old_delay
+        apply_async_patch = mock.patch.object(tasks.send_emails, 'apply_async')
+        self.mock_apply_async = apply_async_patch.start()
+        self.addCleanup(apply_async_patch.stop)
 
     def test_backend_parameters(self):
         """ Our backend should pass kwargs to the 'send_emails' task. """
@@ -271,8 +471,8 @@ class BackendTests(TestCase):
             ('test2', 'Testing with Celery! w00t!!', 'from@example.com', ['to@example.com'])
         ], **kwargs)
 
-        self.assertEqual(len(self._delay_calls), 1)
-        args, kwargs = self._delay_calls[0]
+        self.assertEqual(len(self.mock_apply_async.call_args_list), 1)
+        (args,), options = self.mock_apply_async.call_args_list[0]
         messages, backend_kwargs = args
         self.assertEqual(messages[0]['subject'], 'test1')
         self.assertEqual(messages[1]['subject'], 'test2')
@@ -293,17 +493,172 @@ class BackendTests(TestCase):
             ])
 
             num_chunks = 3  # floor(11.0 / 4.0)
-            self.assertEqual(len(self._delay_calls), num_chunks)
+            self.assertEqual(len(self.mock_apply_async.call_args_list), num_chunks)
 
-            full_tasks = self._delay_calls[:-1]
-            last_task = self._delay_calls[-1]
+            full_tasks = self.mock_apply_async.call_args_list[:-1]
+            last_task = self.mock_apply_async.call_args_list[-1]
 
-            for args, kwargs in full_tasks:
+            for (args,), options in full_tasks:
                 self.assertEqual(len(args[0]), chunksize)
 
-            args, kwargs = last_task
+            (args,), options = last_task
             self.assertEqual(len(args[0]), N % chunksize)
 
+            # all chunks should have been published through the same producer
+            producers = set(id(options['producer']) for args, options in self.mock_apply_async.call_args_list)
+            self.assertEqual(len(producers), 1)
+
+    @override_settings(CELERY_EMAIL_CHUNK_SIZE=0)
+    def test_chunking_invalid_size(self):
+        """ A chunk size of 0 should be an error rather than dropping the messages. """
+        with self.assertRaises(ValueError):
+            mail.send_mail('test', 'body', 'from@example.com', ['to@example.com'])
+        self.assertFalse(self.mock_apply_async.called)
+
+    def test_chunking_growth(self):
+        """ With CELERY_EMAIL_CHUNK_GROWTH chunks should grow as messages are queued. """
+        N = 11
+        for growth, chunksizes in [
+            (None, [4, 4, 3]),
+            ({'threshold': 4, 'max_chunk_size': 8}, [4, 7]),
+            ({'threshold': 16, 'max_chunk_size': 8}, [4, 6, 1]),
+            ({'threshold': 16, 'max_chunk_size': 5}, [4, 5, 2]),
+        ]:
+            self.mock_apply_async.reset_mock()
+            with override_settings(CELERY_EMAIL_CHUNK_SIZE=4, CELERY_EMAIL_CHUNK_GROWTH=growth):
+                mail.send_mass_mail([
+                    ("subject", "body", "from@example.com", ["to@example.com"])
+                    for _ in range(N)
+                ])
+
+            self.assertEqual([len(args[0]) for (args,), options in self.mock_apply_async.call_args_list],
+                             chunksizes)
+
+    def test_chunking_growth_invalid(self):
+        """ An incomplete or invalid CELERY_EMAIL_CHUNK_GROWTH should be reported as such. """
+        for growth in [
+            {'threshold': 4},
+            {'max_chunk_size': 8},
+            {'threshold': 0, 'max_chunk_size': 8},
+            {'threshold': 4, 'max_chunk_size': 0},
+        ]:
+            with override_settings(CELERY_EMAIL_CHUNK_GROWTH=growth):
+                with self.assertRaises(ImproperlyConfigured):
+                    mail.send_mail('test', 'body', 'from@example.com', ['to@example.com'])
+        self.assertFalse(self.mock_apply_async.called)
+
+    @override_settings(CELERY_EMAIL_CHUNK_SIZE=4, CELERY_EMAIL_PUBLISH_THREADS=3)
+    def test_chunking_threaded(self):
+        """ Chunks published from several threads may be queued in any order. """
+        N = 11
+        mail.send_mass_mail([
+            ("subject %02d" % i, "body", "from@example.com", ["to@example.com"])
+            for i in range(N)
+        ])
+
+        self.assertEqual(len(self.mock_apply_async.call_args_list), 3)
+        chunks = sorted((args[0] for (args,), options in self.mock_apply_async.call_args_list),
+                        key=lambda chunk: chunk[0]['subject'])
+        self.assertEqual([len(chunk) for chunk in chunks], [4, 4, 3])
+        self.assertEqual(
+            [message['subject'] for chunk in chunks for message in chunk],
+            ["subject %02d" % i for i in range(N)]
+        )
+
+    @override_settings(CELERY_EMAIL_CHUNK_SIZE=1, CELERY_EMAIL_PUBLISH_THREADS=2)
+    def test_chunking_threaded_lazy(self):
+        """ Threaded publishing should only convert the messages of the chunks in flight. """
+        N = 10
+        threads = 2
+        converted = []
+        published = []
+
+        def mock_email_to_dict(msg, binary=False):
+            converted.append(msg)
+            return email_to_dict(msg)
+
+        def mock_apply_async(args, **options):
+            messages, backend_kwargs = args
+            published.append((int(messages[0]['subject']), len(converted)))
+
+        self.mock_apply_async.side_effect = mock_apply_async
+        with mock.patch.object(backends, 'email_to_dict', mock_email_to_dict):
+            mail.send_mass_mail([
+                (str(i), "body", "from@example.com", ["to@example.com"])
+                for i in range(N)
+            ])
+
+        self.assertEqual(len(published), N)
+        # chunk k is published before chunk k + threads + 1 is converted
+        for index, num_converted in published:
+            self.assertLessEqual(num_converted, index + threads + 1)
+
+    @override_settings(CELERY_EMAIL_CHUNK_SIZE_LADDER=[(0, 8), (100, 4), (1000, 2)])
+    def test_chunking_by_queue_depth(self):
+        """ The chunk size should shrink as the email queue gets deeper. """
+        N = 16
+        for depth, chunksize in [(0, 8), (99, 8), (100, 4), (5000, 2), (None, 10)]:
+            self.mock_apply_async.reset_mock()
+            with mock.patch.object(backends, '_get_queue_depth', return_value=depth):
+                mail.send_mass_mail([
+                    ("subject", "body", "from@example.com", ["to@example.com"])
+                    for _ in range(N)
+                ])
+
+            calls = self.mock_apply_async.call_args_list
+            (args,), options = calls[0]
+            self.assertEqual(len(args[0]), chunksize)
+            self.assertEqual(sum(len(args[0]) for (args,), options in calls), N)
+
+    @override_settings(CELERY_EMAIL_CHUNK_SIZE_LADDER=[(0, 8)])
+    def test_chunking_by_routed_queue_depth(self):
+        """ The depth of the queue the task is routed to should be measured. """
+        app = tasks.send_emails.app
+        router = Router(prepare_routes({'djcelery_email_send_multiple': {'queue': 'mail_routed'}}),
+                        Queues(), create_missing=True, app=app)
+        with mock.patch.object(tasks.send_emails, 'queue', None), \
+                mock.patch.object(app.amqp, 'router', router), \
+                mock.patch.object(backends, '_get_queue_depth', return_value=0) as mock_get_queue_depth:
+            mail.send_mail("subject", "body", "from@example.com", ["to@example.com"])
+
+        mock_get_queue_depth.assert_called_once_with(app, 'mail_routed')
+
+    def test_queue_depth_cached(self):
+        """ The queue depth should only be measured once within QUEUE_DEPTH_TTL. """
+        self.addCleanup(backends._queue_depths.clear)
+        app = FakeBrokerApp(depth=42)
+        self.assertEqual(backends._get_queue_depth(app, 'django_email'), 42)
+        self.assertEqual(backends._get_queue_depth(app, 'django_email'), 42)
+        self.assertEqual(app.declared, [('django_email', True)])
+
+    @skipIf(tasks.send_emails_batched is None, 'celery-batches is not installed')
+    @override_settings(CELERY_EMAIL_USE_BATCHES=True)
+    def test_batching(self):
+        """ With batching enabled every message should be its own request. """
+        with mock.patch.object(tasks.send_emails_batched, 'apply_async') as mock_batched_apply_async:
+            mail.send_mass_mail([
+                ("subject", "body", "from@example.com", ["to@example.com"])
+                for _ in range(3)
+            ])
+
+        self.assertFalse(self.mock_apply_async.called)
+        self.assertEqual(len(mock_batched_apply_async.call_args_list), 3)
+        for (args,), options in mock_batched_apply_async.call_args_list:
+            message, backend_kwargs = args
+            self.assertEqual(message['subject'], 'subject')
+
+    def test_binary_serializer(self):
+        """ Attachments should be sent as bytes when the task uses msgpack. """
+        msg = mail.EmailMessage('test', 'body', 'from@example.com', ['to@example.com'])
+        msg.attach('data.bin', b'\x00\x01\x02', 'application/octet-stream')
+
+        with mock.patch.object(tasks.send_emails, 'serializer', 'msgpack'):
+            msg.send()
+
+        (args,), options = self.mock_apply_async.call_args_list[0]
+        messages, backend_kwargs = args
+        self.assertEqual(messages[0]['attachments'][0][1], b'\x00\x01\x02')
+
 
 class ConfigTests(TestCase):
     """
@@ -315,6 +670,19 @@ class ConfigTests(TestCase):
         self.assertEqual(tasks.send_email.delivery_mode, 1)
         self.assertEqual(tasks.send_email.rate_limit, '50/m')
 
+    def test_default_configs(self):
+        self.assertEqual(tasks.send_email.name, 'djcelery_email_send_multiple')
+        self.assertTrue(tasks.send_email.ignore_result)
+        self.assertTrue(tasks.send_email.acks_late)
+
+    @skipIf(tasks.send_emails_batched is None, 'celery-batches is not installed')
+    def test_batched_configs(self):
+        """ The batched task should not pick up the options of the regular task. """
+        self.assertEqual(tasks.send_emails_batched.name, 'djcelery_email_send_batched')
+        self.assertEqual(tasks.send_emails_batched.queue, 'djcelery_email_batched')
+        self.assertIsNone(tasks.send_emails_batched.rate_limit)
+        self.assertFalse(tasks.send_emails_batched.acks_late)
+
 
 class IntegrationTests(TestCase):
     # We run these tests in ALWAYS_EAGER mode, but they might as well be
@@ -337,6 +705,25 @@ class IntegrationTests(TestCase):
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual(mail.outbox[0].subject, 'test')
 
+    def test_sending_email_object(self):
+        """ In eager mode the message itself should be handed to the task. """
+        msg = mail.EmailMessage('test', 'Testing with Celery! w00t!!', 'from@example.com',
+                                ['to@example.com'])
+        [result] = msg.send()
+        self.assertEqual(result.get(), 1)
+        self.assertIs(mail.outbox[0], msg)
+
+    @override_settings(CELERY_EMAIL_CHUNK_SIZE=2, CELERY_EMAIL_CHUNK_SIZE_LADDER=[(0, 8)])
+    def test_eager_chunk_size(self):
+        """ In eager mode the static chunk size should be used, without asking the broker. """
+        with mock.patch.object(backends, '_get_queue_depth') as mock_get_queue_depth:
+            results = mail.send_mass_mail([
+                ('test', 'body', 'from@example.com', ['to@example.com'])
+                for i in range(5)
+            ])
+        self.assertEqual([result.get() for result in results], [2, 2, 1])
+        mock_get_queue_depth.assert_not_called()
+
     def test_sending_html_email(self):
         msg = EmailMultiAlternatives('test', 'Testing with Celery! w00t!!', 'from@example.com',
                                      ['to@example.com'])
@@ -381,6 +768,15 @@ class IntegrationTests(TestCase):
         self.assertEqual(mail.outbox[0].subject, 'mass 1')
         self.assertEqual(mail.outbox[1].subject, 'mass 2')
 
+    @skipIf(tasks.send_emails_batched is None, 'celery-batches is not installed')
+    @override_settings(CELERY_EMAIL_USE_BATCHES=True)
+    def test_sending_batched_email(self):
+        [result] = mail.send_mail('test', 'Testing with Celery! w00t!!', 'from@example.com',
+                                  ['to@example.com'])
+        self.assertEqual(result.get(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject, 'test')
+
     def test_sending_mass_email_chunked(self):
         emails = [
             ('mass %i' % i, 'message', 'from@example.com', ['to@example.com'])